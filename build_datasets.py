@@ -1,23 +1,84 @@
 import pandas as pd
-from etl_functions import parse_lists
+from etl_functions import parse_lists, calc_ejecution_time, save_serving_dataset
 from scraping_functions import scrape_missing_row
+from profiling_functions import record_rows
+
+items_path = 'CleanDatasets/users_items.csv' # Read in chunks, the users libraries can be too large for memory
+chunk_size = 500_000
 
 df_reviews = pd.read_csv('CleanDatasets/users_reviews.csv', parse_dates=['posted'])
-df_items = pd.read_csv('CleanDatasets/users_items.csv')
 df_games = pd.read_csv('CleanDatasets/steam_games.csv', converters={'genres':parse_lists,'tags':parse_lists})
 df_sentiment = pd.read_csv('CleanDatasets/users_sentiment.csv')
 
-def exploded_df():
-    df = df_items.copy()
-    df = df.merge(df_games[['genres', 'id', 'release_date']], how='left', on='id') 
-    df.dropna(inplace=True) # Drop row if there is no gender or release date information 
-    df['release_date'] = pd.to_datetime(df['release_date']).dt.year
-    exploded_df = df.explode('genres')
-    exploded_df = exploded_df[exploded_df.genres.str.strip() != '']
+@calc_ejecution_time
+def aggregated_df():
+    """
+    Read the users items in chunks, explode every chunk by genre and aggregate the played hours by user, genre
+    and release year into running sums, so the memory depends on the chunk size and the size of the aggregation
+    instead of the size of the users libraries.
+
+    Returns:
+        pandas.DataFrame: The 'playtime_forever' sum for every 'user_id', 'genres' and 'release_date' (year).
+    """
+    keys = ['user_id', 'genres', 'release_date']
+    games = df_games[['genres', 'id', 'release_date']]
+
+    total = None
+    partials = []
+    partial_rows = 0
+    rows_in = 0
+
+    for df in pd.read_csv(items_path, dtype={'user_id': str}, chunksize=chunk_size): # Same dtype in every chunk
+        rows_in += len(df)
+        df = df.merge(games, how='left', on='id') 
+        df.dropna(inplace=True) # Drop row if there is no gender or release date information 
+        df['release_date'] = pd.to_datetime(df['release_date']).dt.year
+        exploded_df = df.explode('genres')
+        exploded_df = exploded_df[exploded_df.genres.astype('object').str.strip() != '']
+
+        partials.append(exploded_df.groupby(keys)['playtime_forever'].sum())
+        partial_rows += len(partials[-1])
+
+        # Merge the partial sums into the running sums once they are as large as a chunk
+        if partial_rows >= chunk_size:
+            total = merge_sums(total, partials)
+            partials, partial_rows = [], 0
+
+    total = merge_sums(total, partials).reset_index()
+    record_rows(rows_in=rows_in, rows_out=len(total))
+
+    return total
+
+def merge_sums(total, partials):
+    """
+    Add partial sums to the running sums.
+
+    Parameters:
+        total (pandas.Series or None): The running sums, indexed by the aggregation keys.
+        partials (list): The partial sums of the last chunks, with the same index levels.
+
+    Returns:
+        pandas.Series: The updated running sums.
+    """
+    series = partials if total is None else [total] + partials
+    series = pd.concat(series)
+
+    return series.groupby(level=list(range(series.index.nlevels))).sum()
+
+def items_names():
+    """
+    Read the first id of every game name in the users items in chunks.
+
+    Returns:
+        pandas.DataFrame: The 'id' and 'item_name' columns without duplicated names.
+    """
+    chunks = [df.drop_duplicates(subset='item_name') for df in pd.read_csv(items_path, usecols=['id', 'item_name'], dtype={'item_name': str}, chunksize=chunk_size)]
 
-    return exploded_df 
+    return pd.concat(chunks).drop_duplicates(subset='item_name')
 
+@calc_ejecution_time
 def df_playtimegenre(df):
+    record_rows(rows_in=len(df))
     df = df.groupby(['genres', 'release_date'])
     df = df['playtime_forever'].sum()
     df = df.reset_index()
@@ -29,9 +90,12 @@ def df_playtimegenre(df):
         ids.append(df[df['genres'] == genre]['playtime_forever'].idxmax())
          
     df = df.loc[ids]
-    df.to_parquet('_src/ApiDatasets/playtimegenre.parquet', index=False)
+    record_rows(rows_out=len(df))
+    save_serving_dataset(df, '_src/ApiDatasets/playtimegenre.parquet', categories=['genres'], integers=['release_date', 'playtime_forever'], index=False)
 
+@calc_ejecution_time
 def df_userforgenre(df):
+    record_rows(rows_in=len(df))
     df_to_get_played_hours = df.groupby(['user_id', 'genres', 'release_date'])
     df_to_get_played_hours = df_to_get_played_hours['playtime_forever'].sum().reset_index()
 
@@ -54,13 +118,16 @@ def df_userforgenre(df):
         id = row.user_id
         df = pd.concat((df, df_to_get_played_hours[(df_to_get_played_hours['genres'] == genre) & (df_to_get_played_hours['user_id'] == id)]))
 
-    df.to_parquet('_src/ApiDatasets/userforgenre.parquet', index=False)
+    record_rows(rows_out=len(df))
+    save_serving_dataset(df, '_src/ApiDatasets/userforgenre.parquet', categories=['user_id', 'genres'], integers=['release_date', 'playtime_forever'], index=False)
 
+@calc_ejecution_time
 def df_user_recommendations():
     df_r = df_reviews.copy()
     df_s = df_games.copy()
-    df_i = df_items.drop_duplicates(subset='item_name')
+    df_i = items_names()
 
+    record_rows(rows_in=len(df_r))
     df_r['year'] = df_r.posted.dt.year
     df_r.drop(columns=['review', 'posted'], inplace=True)
 
@@ -97,12 +164,15 @@ def df_user_recommendations():
     final_false_df['position'] = 1
     final_false_df.loc[1:, 'position'] = list(range(1, 4)) * (len(final_false_df) // 3) #Set the position in the ranking for every year (the first year only have one game with negative reviews)
 
-    final_true_df.to_parquet('_src/ApiDatasets/usersrecommend.parquet')
-    final_false_df.to_parquet('_src/ApiDatasets/usersnotrecommend.parquet')
+    record_rows(rows_out=len(final_true_df) + len(final_false_df))
+    save_serving_dataset(final_true_df, '_src/ApiDatasets/usersrecommend.parquet', categories=['title'], integers=['year', 'position'])
+    save_serving_dataset(final_false_df, '_src/ApiDatasets/usersnotrecommend.parquet', categories=['title'], integers=['year', 'position'])
 
+@calc_ejecution_time
 def df_collaborative_filtering():
     df_s = df_games.copy()
     df_se = df_sentiment.copy()
+    record_rows(rows_in=len(df_se))
 
     # I won't use this columns in my model
     df_se = df_se.drop(columns=['recommend', 'posted'])
@@ -139,16 +209,20 @@ def df_collaborative_filtering():
     # Reorder the columns
     df_merged = df_merged[['user_id', 'title', 'item_id', 'price', 'developer', 'labels', 'sentiment_analysis']]
 
+    record_rows(rows_out=len(df_merged))
     df_merged.to_parquet('CleanDatasets/collaborative_filtering.parquet')
 
+@calc_ejecution_time
 def df_sentiment_analysis():
     df_se = df_sentiment.copy()
+    record_rows(rows_in=len(df_se))
     df_se.drop(['recommend', 'user_id', 'item_id'], axis=1, inplace=True)
     df_se['year'] = pd.to_datetime(df_se['posted']).dt.year
     # Create a dataset with the count for every sentiment analysis labels discretized by year
     df_se = df_se.groupby(['year', 'sentiment_analysis']).agg('count').reset_index().rename({'posted':'count'}, axis=1)
 
-    df_se.to_parquet('_src/ApiDatasets/sentimentanalysis.parquet')
+    record_rows(rows_out=len(df_se))
+    save_serving_dataset(df_se, '_src/ApiDatasets/sentimentanalysis.parquet', integers=['year', 'sentiment_analysis', 'count'])
 
 def combine_columns(row):
     """
@@ -163,9 +237,10 @@ def combine_columns(row):
     else:
         return None
 
+@calc_ejecution_time
 def main():
     """Execute data processing functions."""
-    df = exploded_df()
+    df = aggregated_df()
     df_playtimegenre(df)
     df_userforgenre(df)
     df_user_recommendations()
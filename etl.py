@@ -1,8 +1,10 @@
 import pandas as pd
 import numpy as np
-import re
-from etl_functions import read_json_file, handle_price_exceptions, set_datetime, calc_ejecution_time, parse_lists, convert_html
+import os, re
+from concurrent.futures import ProcessPoolExecutor
+from etl_functions import read_json_file, handle_price_exceptions, set_datetime, calc_ejecution_time, parse_lists, convert_html, ordered_map
 from scraping_functions import scrape_missing_row
+from profiling_functions import record_rows
 
 @calc_ejecution_time
 def reviews_datasets(filename='Datasets/australian_user_reviews.json', return_original=False):
@@ -23,6 +25,7 @@ def reviews_datasets(filename='Datasets/australian_user_reviews.json', return_or
     """
     correct_json = read_json_file(filename)
     df_reviews = pd.json_normalize(correct_json, record_path='reviews', meta='user_id')
+    record_rows(rows_in=len(df_reviews))
 
     columns_order = ['user_id'] + [col for col in df_reviews.columns if col not in ('user_id',)]
     df_reviews = df_reviews.reindex(columns=columns_order)
@@ -40,6 +43,7 @@ def reviews_datasets(filename='Datasets/australian_user_reviews.json', return_or
 
     df_reviews.loc[df_reviews['review'].str.strip() == '', 'review'] = '1' # Set null reviews to neutral
     
+    record_rows(rows_out=len(df_reviews))
     df_reviews.to_csv('CleanDatasets/users_reviews.csv', index=False)
 
 @calc_ejecution_time
@@ -58,57 +62,151 @@ def users_items_dataset(filename='Datasets/australian_users_items.json'):
     """
     correct_json = read_json_file(filename)
     df_users_items = pd.json_normalize(correct_json, record_path='items', meta='user_id')
+    record_rows(rows_in=len(df_users_items), rows_out=len(df_users_items))
     df_users_items.drop('playtime_2weeks', axis=1, inplace=True) # Useless column
     df_users_items.rename(columns={'item_id':'id'}, inplace=True)
 
     df_users_items.to_csv('CleanDatasets/users_items.csv', index=False)
 
-@calc_ejecution_time
-def steam_games_dataset(filename='Datasets/steam_games.json.gz', return_original=False):
+def drop_empty_games(df):
     """
-    Process a dataset of Steam games from a compressed JSON file and save it as a CSV file.
+    Drop the games without information and the useless columns of a chunk of the Steam games dataset.
 
     Parameters:
-        filename (str, optional): The name of the compressed JSON file containing Steam games data. 
-            Defaults to 'Datasets/steam_games.json.gz'.
+        df (pandas.DataFrame): A chunk of the raw Steam games dataset.
 
     Returns:
-        pandas.DataFrame or None: If 'return_original' is True, returns the processed DataFrame. Otherwise, saves it as 'steam_games.csv'
+        pandas.DataFrame: The chunk without empty rows and useless columns.
+    """
+    df = df.dropna(thresh=5)
+    df = df.drop(columns=['reviews_url', 'specs', 'early_access','app_name','publisher'], errors='ignore') # Useless columns
 
-    Raises:
-        FileNotFoundError: If the specified compressed JSON file does not exist.
+    return df
+
+def clean_games_chunk(df):
     """
-    df_games = pd.read_json(filename, lines=True, compression='gzip')
-    df_games.dropna(thresh=5, inplace=True)
-    df_games.drop(columns=['reviews_url', 'specs', 'early_access','app_name','publisher'], inplace=True) # Useless columns
-    df_games.reset_index(drop=True, inplace=True)
+    First cleaning pass of a chunk of the Steam games dataset: fill the ids and titles and remove duplicated games
+    inside the chunk. Runs in a worker process.
 
-    if return_original == True:
-        return df_games
+    Parameters:
+        df (pandas.DataFrame): A chunk of the raw Steam games dataset.
 
-    df_games['id'].fillna(df_games['url'].str.extract(r'([0-9]+)')[0].astype('float'), inplace=True) # Extract id from url
-    df_games['id'] = df_games['id'].astype(int) # Remove dots
-    df_games.drop_duplicates(subset='id', inplace=True) # Remove duplicated games
+    Returns:
+        pandas.DataFrame: The cleaned chunk.
+    """
+    df = drop_empty_games(df)
+    if df.empty:
+        return df
+
+    df['id'] = df['id'].fillna(df['url'].str.extract(r'([0-9]+)')[0].astype('float')) # Extract id from url
+    df['id'] = df['id'].astype(int) # Remove dots
+    df = df.drop_duplicates(subset='id') # Remove duplicated games
 
-    df_games['title'].fillna(df_games['url'].apply(lambda x: x.split('/')[-2].replace('_', ' ').replace('  ', ' ')), inplace=True)
+    df['title'] = df['title'].fillna(df['url'].str.split('/').str[-2].str.replace('_', ' ').str.replace('  ', ' '))
     # Extract title from url
 
-    df_games = df_games.replace(['', ' ', '  '], np.nan)
+    df = df.replace(['', ' ', '  '], np.nan)
+
+    return df
+
+def finish_games_chunk(df):
+    """
+    Second cleaning pass of a chunk of the Steam games dataset, once the duplicated games are removed and the
+    missing data is scraped: clean the price, genres, tags and release date columns. Runs in a worker process.
+
+    Parameters:
+        df (pandas.DataFrame): A chunk cleaned by 'clean_games_chunk' without games of previous chunks, with the
+            missing data already scraped.
 
-    df_games = scrape_missing_row(df_games) # Web scraping
-    df_games = df_games.replace('', np.nan)
+    Returns:
+        pandas.DataFrame: The clean chunk.
+    """
+    if df.empty:
+        return df
 
-    df_games['price'].fillna(0, inplace=True)
-    df_games['price'] = df_games['price'].apply(handle_price_exceptions) # Clean price column
+    df = df.replace('', np.nan)
 
-    df_games['genres'] = df_games['genres'].apply(parse_lists).apply(convert_html)
+    df['price'] = df['price'].fillna(0)
+    df['price'] = df['price'].apply(handle_price_exceptions) # Clean price column
+
+    df['genres'] = df['genres'].apply(parse_lists).apply(convert_html)
     # Convert strings to lists and convert html characters to unicode
-    df_games['tags'] = df_games['tags'].apply(parse_lists).apply(convert_html) 
+    df['tags'] = df['tags'].apply(parse_lists).apply(convert_html) 
+
+    df['release_date'] = pd.to_datetime(df['release_date'], format='mixed', errors='coerce')
+
+    return df
+
+@calc_ejecution_time
+def steam_games_dataset(filename='Datasets/steam_games.json.gz', return_original=False, chunk_size=20_000, n_jobs=None):
+    """
+    Process a dataset of Steam games from a compressed JSON file and save it as a CSV file.
+
+    The file is decompressed and parsed in chunks, every chunk is cleaned in parallel worker processes, the
+    duplicated games are removed across chunks and the clean chunks are appended to the CSV file in order, so the
+    memory depends on the chunk size instead of the file size. The missing data is scraped one request at a time
+    in the main process, so the Steam store isn't hit by every worker at once; only the CPU bound cleaning runs
+    in parallel.
+
+    Parameters:
+        filename (str, optional): The name of the compressed JSON file containing Steam games data. 
+            Defaults to 'Datasets/steam_games.json.gz'.
+        return_original (bool, optional): Whether to return the DataFrame without empty rows and useless columns
+            instead of cleaning it. Defaults to False.
+        chunk_size (int, optional): The number of lines parsed at once. Defaults to 20000.
+        n_jobs (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        pandas.DataFrame or None: If 'return_original' is True, returns the processed DataFrame. Otherwise, saves it as 'steam_games.csv'
 
-    df_games['release_date'] = pd.to_datetime(df_games['release_date'], format='mixed', errors='coerce')
+    Raises:
+        FileNotFoundError: If the specified compressed JSON file does not exist.
+    """
+    reader = pd.read_json(filename, lines=True, compression='gzip', chunksize=chunk_size)
 
-    df_games.to_csv('CleanDatasets/steam_games.csv', index=False)
+    if return_original == True:
+        return pd.concat([drop_empty_games(df) for df in reader]).reset_index(drop=True)
+
+    n_jobs = n_jobs or os.cpu_count()
+    seen_ids = set()
+    columns = None
+    rows_in = 0
+    rows_out = 0
+
+    def count_rows(reader):
+        nonlocal rows_in
+        for df in reader:
+            rows_in += len(df)
+            yield df
+
+    def drop_seen_games(chunks):
+        for df in chunks:
+            if not df.empty:
+                df = df[~df['id'].isin(seen_ids)] # Remove games already found in previous chunks
+                seen_ids.update(df['id'])
+            yield df
+
+    def scrape_chunks(chunks):
+        for df in chunks:
+            yield scrape_missing_row(df) if not df.empty else df # Web scraping
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        cleaned = ordered_map(executor, clean_games_chunk, count_rows(reader), window=2 * n_jobs)
+        finished = ordered_map(executor, finish_games_chunk, scrape_chunks(drop_seen_games(cleaned)), window=2 * n_jobs)
+
+        for df in finished:
+            if df.empty:
+                continue
+            if columns is None: # Write the header with the first clean chunk
+                columns = list(df.columns)
+                df.to_csv('CleanDatasets/steam_games.csv', index=False)
+            else:
+                df.reindex(columns=columns).to_csv('CleanDatasets/steam_games.csv', index=False, header=False, mode='a')
+            rows_out += len(df)
+
+    record_rows(rows_in=rows_in, rows_out=rows_out)
 
+@calc_ejecution_time
 def main(): 
     """Execute data processing functions."""
     reviews_datasets()
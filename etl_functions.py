@@ -1,5 +1,9 @@
-import ast, re, time, html
+import ast, re, html
+import pandas as pd
+from collections import deque
 from datetime import datetime
+from functools import wraps
+from profiling_functions import trace_span
 
 def read_json_file(filename):
     """
@@ -116,14 +120,71 @@ def convert_html(list_):
     except (AttributeError, TypeError):
         return list_
     
+def ordered_map(executor, func, iterable, window):
+    """
+    Apply a function to the elements of an iterable in an executor, keeping at most 'window' tasks in flight.
+    Unlike 'executor.map', the iterable is consumed lazily, so large inputs (like chunks of a file) are never
+    fully loaded in memory.
+
+    Parameters:
+        executor (concurrent.futures.Executor): The executor that runs the tasks.
+        func (callable): The function to apply.
+        iterable (iterable): The elements to process.
+        window (int): The maximum number of tasks submitted and not yet returned.
+
+    Yields:
+        The results of the function, in the order of the iterable.
+    """
+    pending = deque()
+
+    for element in iterable:
+        pending.append(executor.submit(func, element))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+def save_serving_dataset(df, path, categories=(), integers=(), index=True):
+    """
+    Save a dataset served by the API with compact dtypes, so every API worker holds less memory.
+    String columns with repeated values are converted to categorical (dictionary encoded in Parquet) and
+    integer columns are downcast to the smallest integer type that fits their values.
+
+    Parameters:
+        df (pandas.DataFrame): The dataset to save.
+        path (str): The path of the Parquet file.
+        categories (list, optional): The columns to convert to categorical.
+        integers (list, optional): The integer columns to downcast.
+        index (bool, optional): Whether to save the index. Defaults to True.
+
+    Returns:
+        pandas.DataFrame: The dataset with compact dtypes.
+    """
+    memory_before = df.memory_usage(deep=True).sum()
+
+    df = df.astype({column: 'category' for column in categories})
+    for column in integers:
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+
+    memory_after = df.memory_usage(deep=True).sum()
+    print(f"Memory of '{path}': {round(memory_before / 1024 ** 2, 2)} MB -> {round(memory_after / 1024 ** 2, 2)} MB")
+
+    df.to_parquet(path, index=index)
+
+    return df
+
 def calc_ejecution_time(func):
-    """Decorator to measure the execution time of a function."""
+    """
+    Decorator to measure the execution time of a function.
+    The function runs inside a profiling span (see 'profiling_functions.trace_span'), so its CPU time, memory
+    and rows are also recorded in the JSON trace of the run.
+    """
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        time_elapsed = end - start
-        time_elapsed = round(time_elapsed, 2)
+        with trace_span(func.__name__) as span:
+            result = func(*args, **kwargs)
+        time_elapsed = round(span.wall_time, 2)
         print(f"Time elapsed in '{func.__name__}': {time_elapsed} seconds")
         return result
-    return wrapper
+    return wrapper
\ No newline at end of file
@@ -0,0 +1,216 @@
+import pandas as pd
+import numpy as np
+import gc, os, time, tracemalloc
+from datetime import datetime
+import tensorflow as tf
+from etl_functions import calc_ejecution_time
+from profiling_functions import reset_memory_peak, current_rss
+from user_item import load_interactions, train_model, materialize_recommendations
+from item_item import prepare_dataset, calculate_cosine_sim
+
+report_path = 'Reports/evaluation.csv'
+
+def normalize_title(title):
+    """Normalize a title so the titles of the interactions and of the recommendations can be compared."""
+    return str(title).strip().title()
+
+def holdout_split(df, seed=42):
+    """
+    Hold out one random interaction of every user with at least two different games.
+
+    Parameters:
+        df (pandas.DataFrame): The interactions, with the 'user_id' and 'title' columns.
+        seed (int, optional): The random seed of the split. Defaults to 42.
+
+    Returns:
+        tuple: The train and test interactions.
+    """
+    df = df.drop_duplicates(subset=['user_id', 'title']).reset_index(drop=True)
+    counts = df.groupby('user_id')['title'].transform('count')
+
+    test = df[counts >= 2].sample(frac=1, random_state=seed).drop_duplicates(subset='user_id')
+    train = df.drop(test.index)
+
+    return train, test
+
+def user_item_backends(train, k, batch_size=8192, epochs=2):
+    """
+    Train the user-item model on the train interactions and return the recommendation functions of
+    its retrieval index and of its materialized top-k table.
+
+    Like the item-item backend, the recommendations skip the duplicated titles and the train games of the user,
+    so more than k candidates are retrieved and the first k remaining ones are returned. The materialized table
+    is scored on its own: it stores 2k titles per user and returns fewer than k when not enough of them are new.
+
+    Parameters:
+        train (pandas.DataFrame): The train interactions.
+        k (int): The number of recommendations.
+        batch_size (int, optional): The number of interactions per training batch. Defaults to 8192.
+        epochs (int, optional): The number of training epochs. Defaults to 2.
+
+    Returns:
+        dict: The functions that return the recommended titles for a user and their train games, by backend name.
+    """
+    model, index = train_model(train, batch_size=batch_size, epochs=epochs, save=False)
+    n_candidates = train['title'].nunique()
+    table = materialize_recommendations(model, index, n=min(2 * k, n_candidates), save=False)
+    table = dict(zip(table['user_id'], table['recommendations']))
+
+    def first_new_titles(titles, games):
+        seen = set(games) # The games are already normalized
+        recommendations = []
+        for title in titles:
+            if normalize_title(title) not in seen:
+                seen.add(normalize_title(title))
+                recommendations.append(title)
+            if len(recommendations) == k:
+                break
+        return recommendations
+
+    def recommend_bruteforce(user_id, games):
+        _, titles = index(tf.constant([user_id]), k=min(2 * k + len(games), n_candidates))
+        titles = [title.decode('utf-8').split(',')[0] for title in titles[0].numpy().tolist()] # Same titles as the API
+        return first_new_titles(titles, games)
+
+    def recommend_materialized(user_id, games):
+        return first_new_titles(table.get(user_id, []), games)
+
+    return {'user_item_bruteforce': recommend_bruteforce, 'user_item_materialized': recommend_materialized}
+
+def item_item_backend(k):
+    """
+    Build the item-item neighbours and return their recommendation function.
+
+    The games of the user are used as seeds, and their neighbours are ranked by their highest similarity.
+
+    Parameters:
+        k (int): The number of recommendations.
+
+    Returns:
+        function: A function that returns the recommended titles for a user and their train games.
+    """
+    data = prepare_dataset(save=False)
+    item_neighbors = calculate_cosine_sim(data, k=k, save=False)
+    titles = data['title'].str.strip().to_numpy()
+    positions = {title: i for i, title in enumerate(titles)}
+
+    def recommend(user_id, games):
+        seeds = [positions[game] for game in games if game in positions]
+        if not seeds:
+            return []
+        neighbors = item_neighbors['neighbors'][seeds].ravel()
+        scores = item_neighbors['scores'][seeds].ravel()
+        ranking = pd.Series(scores).groupby(neighbors).max().sort_values(ascending=False, kind='stable')
+        ranking = ranking[~ranking.index.isin(seeds)] # Don't recommend the games the user already has
+        return titles[ranking.index[:k].to_numpy()].tolist()
+
+    return recommend
+
+def evaluate_backend(name, recommend, train, test, n_titles, k):
+    """
+    Measure the quality, latency and memory of a recommendation backend on the held-out interactions.
+
+    Parameters:
+        name (str): The name of the backend.
+        recommend (function): The recommendation function of the backend.
+        train (pandas.DataFrame): The train interactions.
+        test (pandas.DataFrame): The held-out interactions.
+        n_titles (int): The number of titles in the catalogue.
+        k (int): The number of recommendations.
+
+    Returns:
+        dict: The recall@k, coverage, latencies and memory of the backend.
+    """
+    user_games = train.groupby('user_id')['title'].agg(lambda titles: [normalize_title(title) for title in titles])
+
+    hits = 0
+    recommended = set()
+    latencies = []
+
+    # The queries are timed without tracing the allocations, which would slow the Python heavy backends the most
+    for row in test.itertuples():
+        games = user_games.get(row.user_id, [])
+
+        start = time.perf_counter()
+        recommendations = recommend(row.user_id, games)
+        latencies.append(time.perf_counter() - start)
+
+        recommendations = [normalize_title(title) for title in recommendations[:k]]
+        hits += normalize_title(row.title) in recommendations
+        recommended.update(recommendations)
+
+    # Then their memory is measured in a second pass with tracemalloc
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    reset_memory_peak() # Only count the queries, not the build of the backend
+    rss_start = current_rss()
+
+    for row in test.itertuples():
+        recommend(row.user_id, user_games.get(row.user_id, []))
+
+    _, peak = tracemalloc.get_traced_memory()
+    rss_growth = current_rss() - rss_start
+    if started_tracing:
+        tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'backend': name,
+        'k': k,
+        'queries': len(test),
+        f'recall@{k}': round(hits / len(test), 4),
+        'coverage': round(len(recommended) / n_titles, 4),
+        'mean_ms': round(latencies.mean(), 3),
+        'p50_ms': round(np.percentile(latencies, 50), 3),
+        'p95_ms': round(np.percentile(latencies, 95), 3),
+        'query_peak_mb': round(peak / 1024 ** 2, 2),
+        'query_rss_mb': round(rss_growth / 1024 ** 2, 2)
+        }
+
+def save_report(results):
+    """
+    Append the results to the evaluation report, so runs of different backends and versions can be compared.
+
+    Parameters:
+        results (list): A list of dictionaries with the results of every backend.
+    """
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    report = pd.DataFrame(results)
+
+    if os.path.exists(report_path):
+        report = pd.concat((pd.read_csv(report_path), report), ignore_index=True)
+
+    report.to_csv(report_path, index=False)
+
+@calc_ejecution_time
+def main(k=5, max_queries=2000, seed=42):
+    """Evaluate the user-item and item-item recommenders on a held-out split."""
+    df = load_interactions()
+    train, test = holdout_split(df, seed=seed)
+    test = test.sample(min(max_queries, len(test)), random_state=seed)
+    n_titles = df['title'].str.strip().str.title().nunique()
+
+    # The backends are built one group at a time, so the memory of each build is measured on its own
+    builders = [lambda: user_item_backends(train, k), lambda: {'item_item_topk': item_item_backend(k)}]
+
+    results = []
+    for build in builders:
+        rss_start = current_rss()
+        backends = build()
+        build_rss = round((current_rss() - rss_start) / 1024 ** 2, 2)
+
+        for name, recommend in backends.items():
+            results.append(evaluate_backend(name, recommend, train, test, n_titles, k))
+            results[-1]['build_rss_mb'] = build_rss
+            print(results[-1])
+
+        del backends
+        gc.collect()
+
+    save_report(results)
+
+if __name__ == "__main__":
+    main()
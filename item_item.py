@@ -1,38 +1,103 @@
 import pandas as pd
+import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
+from joblib import Parallel, delayed
 import joblib
+from etl_functions import calc_ejecution_time, save_serving_dataset
+from profiling_functions import record_rows
 
-def prepare_dataset():
+@calc_ejecution_time
+def prepare_dataset(save=True):
     """
     Removes duplicate entries based on 'title', preprocesses the 'labels' and 'developer'
-    columns to create 'items_data', and saves the resulting dataset to a new Parquet file.
+    columns to create 'items_data', and saves the titles and ids (the only columns the API reads)
+    to a new Parquet file.
+
+    Parameters:
+    save (bool, optional): Whether to save the dataset. Defaults to True.
     """
     data = pd.read_parquet('CleanDatasets/collaborative_filtering.parquet')
+    record_rows(rows_in=len(data))
     data = data.drop_duplicates(subset='title').reset_index(drop=True)
     data['items_data'] = data['labels'].astype('str').apply(lambda x: x.replace('[', '').replace(']', '')) + ' ' + data['developer']
     data = data[['title','item_id','items_data']]
     data['title'] = data['title'].str.title()
+    record_rows(rows_out=len(data))
 
-    data.to_parquet('_src/ApiDatasets/item_item.parquet')
+    if save:
+        save_serving_dataset(data[['title', 'item_id']], '_src/ApiDatasets/item_item.parquet', integers=['item_id'])
     
     return data
 
-def calculate_cosine_sim(data):
+def block_top_k(tfidf_matrix, start, end, k):
     """
-    Computes the TF-IDF vectorization and cosine similarity matrix for the 'items_data'
-    column of the input dataset. The resulting cosine similarity matrix is then saved
-    using joblib to '_src/Models/cosine_sim.joblib'.
+    Computes the cosine similarity between a block of rows and the whole TF-IDF matrix and keeps
+    the 'k' most similar games of every row, excluding the game itself.
+
+    Parameters:
+    tfidf_matrix (scipy.sparse.csr_matrix): The L2 normalized TF-IDF matrix.
+    start (int): The first row of the block.
+    end (int): The row after the last row of the block.
+    k (int): The number of neighbours to keep for every row.
+
+    Returns:
+    tuple: Two [rows x k] arrays with the neighbours indices and their similarity scores, ordered by similarity.
+    """
+    cosine_sim = (tfidf_matrix[start:end] @ tfidf_matrix.T).toarray() # The vectors are normalized, so the dot product is the cosine similarity
+
+    rows = np.arange(end - start)
+    cosine_sim[rows, rows + start] = -np.inf # Exclude the game itself
+
+    neighbors = np.argpartition(-cosine_sim, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(cosine_sim, neighbors, axis=1)
+
+    order = np.argsort(-scores, axis=1, kind='stable') # Order the neighbours by similarity
+    neighbors = np.take_along_axis(neighbors, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+
+    return neighbors.astype(np.int32), scores.astype(np.float32)
+
+@calc_ejecution_time
+def calculate_cosine_sim(data, k=50, block_size=256, n_jobs=-1, save=True):
+    """
+    Computes the TF-IDF vectorization of the 'items_data' column of the input dataset and
+    the 'k' most similar games of every game by cosine similarity. The similarity is computed
+    in blocks of rows that can be spread across cores, so the full [m x m] matrix is never
+    materialized. The neighbours and their scores are then saved using joblib to
+    '_src/Models/item_neighbors.joblib'.
 
     Parameters:
     data (pandas.DataFrame): The dataset containing the 'items_data' column.
+    k (int, optional): The number of neighbours to keep for every game. Defaults to 50.
+    block_size (int, optional): The number of rows of every block. Defaults to 256.
+    n_jobs (int, optional): The number of parallel jobs. Defaults to -1 (all cores).
+    save (bool, optional): Whether to save the neighbours. Defaults to True.
+
+    Returns:
+    dict: A dictionary with the [m x k] arrays 'neighbors' and 'scores'.
     """
-    tfidf_vectorizer = TfidfVectorizer(stop_words='english')
-    tfidf_matrix = tfidf_vectorizer.fit_transform(data['items_data'])
-    cosine_sim = linear_kernel(tfidf_matrix, tfidf_matrix)
+    tfidf_vectorizer = TfidfVectorizer(stop_words='english', dtype=np.float32)
+    tfidf_matrix = tfidf_vectorizer.fit_transform(data['items_data']).tocsr()
+
+    n_items = tfidf_matrix.shape[0]
+    record_rows(rows_in=n_items, rows_out=n_items)
+    k = min(k, n_items - 1)
+
+    blocks = Parallel(n_jobs=n_jobs)(
+        delayed(block_top_k)(tfidf_matrix, start, min(start + block_size, n_items), k)
+        for start in range(0, n_items, block_size))
+
+    item_neighbors = {
+        'neighbors': np.vstack([neighbors for neighbors, _ in blocks]),
+        'scores': np.vstack([scores for _, scores in blocks])
+        }
+
+    if save:
+        joblib.dump(item_neighbors, '_src/Models/item_neighbors.joblib', compress=True)
 
-    joblib.dump(cosine_sim, '_src/Models/cosine_sim.joblib', compress=True)
+    return item_neighbors
 
+@calc_ejecution_time
 def main():
     data = prepare_dataset()
     calculate_cosine_sim(data)
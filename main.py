@@ -1,19 +1,41 @@
 from fastapi import FastAPI, HTTPException
 import pandas as pd
 import joblib
+import os
+from profiling_functions import current_rss
 
 from tensorflow.python.ops.numpy_ops import np_config
 np_config.enable_numpy_behavior()
 from keras.models import load_model
 
+def load_user_recommendations(path):
+    """
+    Load the materialized recommendations as a dictionary of plain lists of titles by user id.
+    The rows are ordered by user and position, and the titles come from the categories of the column, so every
+    title string is shared by all the lists. The DataFrame is only used while loading.
+    If the table hasn't been generated yet (see 'user_item.py'), every user is served by the model.
+    """
+    if not os.path.exists(path):
+        print(f"'{path}' not found, every user will be recommended by the model")
+        return {}
+
+    df = pd.read_parquet(path)
+    recommendations = {}
+    for user_id, title in zip(df['user_id'].tolist(), df['title'].tolist()):
+        recommendations.setdefault(user_id, []).append(title)
+    return recommendations
+
+rss_before = current_rss()
 playtimegenre_df = pd.read_parquet('./_src/ApiDatasets/playtimegenre.parquet')
 userforgenre_df = pd.read_parquet('./_src/ApiDatasets/userforgenre.parquet')
 usersrecommend_df = pd.read_parquet('./_src/ApiDatasets/usersrecommend.parquet')
 usersnotrecommend_df = pd.read_parquet('./_src/ApiDatasets/usersnotrecommend.parquet')
 sentimentanalysis_df = pd.read_parquet('./_src/ApiDatasets/sentimentanalysis.parquet')
 item_item_df = pd.read_parquet('./_src/ApiDatasets/item_item.parquet')
-cosine_sim = joblib.load('./_src/Models/cosine_sim.joblib')
+item_neighbors = joblib.load('./_src/Models/item_neighbors.joblib')
+user_recommendations = load_user_recommendations('./_src/ApiDatasets/user_recommendations.parquet')
 model = load_model('./_src/Models/collaborative_filtering')
+print(f'Datasets and models loaded, worker RSS: {round(rss_before / 1024 ** 2, 2)} MB -> {round(current_rss() / 1024 ** 2, 2)} MB')
 
 app = FastAPI()
 
@@ -88,12 +110,17 @@ async def sentimentanalysis(year:int):
 @app.get('/UserRecommendation/{user_id}')
 async def userrecommendation(user_id:str):
 
-    scores, titles = model([user_id])
-    return{f"Recommendations for the user {user_id}": [title.decode('utf-8').split(',')[0] for title in titles[0,:5].tolist()]}
+    recommendations = user_recommendations.get(user_id)
+
+    if recommendations is None: # Unknown user, run the model
+        scores, titles = model([user_id])
+        recommendations = [title.decode('utf-8').split(',')[0] for title in titles[0,:5].tolist()]
+
+    return{f"Recommendations for the user {user_id}": recommendations}
 
 @app.get('/ItemRecommendation/{item}')
 async def itemrecommendation(item:str):
-    data = item_item_df.copy()
+    data = item_item_df
 
     try:
         try:
@@ -106,10 +133,7 @@ async def itemrecommendation(item:str):
         raise HTTPException(status_code=404, detail=f"The game {item} doesn't exists in our database")
     
     idx = data.index[data['title'] == item].tolist()[0]
-    sim_scores = list(enumerate(cosine_sim[idx])) # Select the title specific vector
-    sim_scores = sorted(sim_scores, key=lambda x: x[1], reverse=True) # Order by similarity
-    sim_scores = sim_scores[1:6] # Choose the 5 more similar
-    game_indices = [i[0] for i in sim_scores] # Get the 5 game titles
+    game_indices = item_neighbors['neighbors'][idx, :5].tolist() # The neighbours are already ordered by similarity, choose the 5 more similar
 
     recommendations = [data["title"].iloc[i].strip() for i in game_indices]
 
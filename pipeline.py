@@ -0,0 +1,212 @@
+import hashlib, json, os, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+cache_path = '.pipeline_cache.json'
+
+class Stage:
+    """
+    A stage of the offline pipeline: a script with the files it reads and the files it writes.
+
+    Parameters:
+        name (str): The name of the stage.
+        script (str): The script executed by the stage.
+        inputs (list): The files or directories the script reads.
+        outputs (list): The files or directories the script writes.
+        sources (list, optional): The helper modules imported by the script. Defaults to none.
+        args (list, optional): Extra command line arguments of the script. Defaults to none.
+    """
+    def __init__(self, name, script, inputs, outputs, sources=(), args=()):
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.sources = list(sources)
+        self.args = list(args)
+
+    def key(self):
+        """
+        Hash the script, its helper modules and its inputs, so the stage only runs again when one of them changes.
+
+        Returns:
+            str: The hexadecimal hash of the stage.
+        """
+        digest = hashlib.sha256()
+        for path in [self.script] + self.sources + self.inputs + self.args:
+            digest.update(path.encode('utf-8'))
+            digest.update(hash_path(path).encode('utf-8'))
+        return digest.hexdigest()
+
+    def run(self):
+        """
+        Execute the script of the stage.
+
+        Returns:
+            int: The return code of the script.
+        """
+        return subprocess.run([sys.executable, self.script] + self.args).returncode
+
+def hash_path(path):
+    """
+    Hash the content of a file, or of all the files of a directory.
+
+    Parameters:
+        path (str): The path of the file or directory.
+
+    Returns:
+        str: The hexadecimal hash of the content, or 'missing' if the path doesn't exist.
+    """
+    if not os.path.exists(path):
+        return 'missing'
+
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+    digest = hashlib.sha256()
+    for filename in files:
+        digest.update(os.path.relpath(filename, path).encode('utf-8'))
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+STAGES = [
+    Stage('etl', 'etl.py',
+          inputs=['Datasets/australian_user_reviews.json', 'Datasets/australian_users_items.json', 'Datasets/steam_games.json.gz'],
+          outputs=['CleanDatasets/users_reviews.csv', 'CleanDatasets/users_items.csv', 'CleanDatasets/steam_games.csv'],
+          sources=['etl_functions.py', 'scraping_functions.py', 'profiling_functions.py']),
+    Stage('sentiment_analysis', 'sentiment_analysis.py',
+          inputs=['CleanDatasets/users_reviews.csv'],
+          outputs=['CleanDatasets/users_sentiment.csv'],
+          sources=['etl_functions.py', 'translation_functions.py', 'profiling_functions.py']),
+    Stage('build_datasets', 'build_datasets.py',
+          inputs=['CleanDatasets/users_reviews.csv', 'CleanDatasets/users_items.csv', 'CleanDatasets/steam_games.csv', 'CleanDatasets/users_sentiment.csv'],
+          outputs=['_src/ApiDatasets/playtimegenre.parquet', '_src/ApiDatasets/userforgenre.parquet', '_src/ApiDatasets/usersrecommend.parquet',
+                   '_src/ApiDatasets/usersnotrecommend.parquet', '_src/ApiDatasets/sentimentanalysis.parquet', 'CleanDatasets/collaborative_filtering.parquet'],
+          sources=['etl_functions.py', 'scraping_functions.py', 'profiling_functions.py']),
+    Stage('item_item', 'item_item.py',
+          inputs=['CleanDatasets/collaborative_filtering.parquet'],
+          outputs=['_src/ApiDatasets/item_item.parquet', '_src/Models/item_neighbors.joblib'],
+          sources=['etl_functions.py', 'profiling_functions.py']),
+    Stage('user_item', 'user_item.py',
+          inputs=['CleanDatasets/collaborative_filtering.parquet'],
+          outputs=['Models/collaborative_filtering', 'Models/collaborative_filtering_state', '_src/ApiDatasets/user_recommendations.parquet'],
+          sources=['etl_functions.py', 'profiling_functions.py'])
+    ]
+
+class Pipeline:
+    """
+    Runs the stages of the offline pipeline in dependency order.
+
+    A stage depends on the stages that write its inputs. Stages whose dependencies are done run in parallel,
+    and a stage is skipped when its hash matches the one of its last successful run and its outputs exist.
+
+    Parameters:
+        stages (list): The stages of the pipeline.
+        max_workers (int, optional): The maximum number of stages running at once. Defaults to 2.
+        force (bool, optional): Whether to run every stage even if it hasn't changed. Defaults to False.
+
+    Attributes:
+        dependencies (dict): The names of the stages every stage depends on.
+        cache (dict): The hash of the last successful run of every stage.
+        summary (list): The (stage, status, seconds) tuples of the last run.
+    """
+    def __init__(self, stages, max_workers=2, force=False):
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_workers = max_workers
+        self.force = force
+        self.summary = []
+
+        producers = {output: stage.name for stage in stages for output in stage.outputs}
+        self.dependencies = {stage.name: {producers[path] for path in stage.inputs if path in producers} - {stage.name} for stage in stages}
+
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                self.cache = json.load(f)
+
+    def execute(self, stage):
+        """
+        Run a stage unless it hasn't changed since its last successful run.
+
+        Parameters:
+            stage (Stage): The stage to run.
+
+        Returns:
+            tuple: The status of the stage ('cached', 'done' or 'failed'), its hash and the elapsed seconds.
+        """
+        start = time.perf_counter()
+        key = stage.key()
+
+        if not self.force and self.cache.get(stage.name) == key and all(os.path.exists(path) for path in stage.outputs):
+            return 'cached', key, time.perf_counter() - start
+
+        status = 'done' if stage.run() == 0 else 'failed'
+        return status, key, time.perf_counter() - start
+
+    def run(self):
+        """
+        Run the pipeline and print a timing summary of every stage.
+
+        Returns:
+            bool: Whether every stage finished successfully.
+        """
+        pending = set(self.stages)
+        finished = set()
+        running = {}
+        self.summary = []
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in sorted(pending):
+                    if self.dependencies[name] <= finished:
+                        pending.remove(name)
+                        running[executor.submit(self.execute, self.stages[name])] = name
+
+                if not running: # The remaining stages depend on a failed stage
+                    self.summary.extend((name, 'skipped', 0) for name in sorted(pending))
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    status, key, elapsed = future.result()
+                    self.summary.append((name, status, elapsed))
+
+                    if status != 'failed':
+                        finished.add(name)
+                        self.cache[name] = key
+                        self.save_cache()
+
+        self.print_summary(time.perf_counter() - start)
+
+        return all(status in ('done', 'cached') for _, status, _ in self.summary)
+
+    def save_cache(self):
+        """Save the hashes of the successful stages."""
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(self.cache, f, indent=2)
+
+    def print_summary(self, total):
+        """
+        Print the status and elapsed time of every stage.
+
+        Parameters:
+            total (float): The wall-clock seconds of the whole pipeline.
+        """
+        width = max(len(name) for name in self.stages)
+        for name, status, elapsed in self.summary:
+            print(f'{name:<{width}}  {status:<7}  {round(elapsed, 2)} seconds')
+        print(f'{"total":<{width}}  {"":<7}  {round(total, 2)} seconds')
+
+def main(force=False, int8=False):
+    """Execute the offline pipeline."""
+    if int8: # Label the reviews with the int8 quantized sentiment model
+        next(stage for stage in STAGES if stage.name == 'sentiment_analysis').args.append('--int8')
+
+    succeeded = Pipeline(STAGES, force=force).run()
+    sys.exit(0 if succeeded else 1)
+
+if __name__ == "__main__":
+    main(force='--force' in sys.argv, int8='--int8' in sys.argv)
@@ -0,0 +1,191 @@
+import cProfile, json, os, resource, sys, time, tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+trace_dir = 'Traces'
+stack = [] # Open spans of the current run, the root span first
+profiler = None # cProfile profiler of the run, owned by the outermost span that enabled it
+
+class Span:
+    """
+    A timed section of a run, with its resources usage, its row counts and its nested spans.
+
+    Parameters:
+        name (str): The name of the span.
+
+    Attributes:
+        wall_time (float): The wall-clock seconds of the span.
+        cpu_time (float): The CPU seconds of the process during the span.
+        peak_memory (int or None): The peak of memory traced by tracemalloc during the span, in bytes.
+            None if memory tracing was off.
+        peak_rss (int): The peak resident memory of the process at the end of the span, in bytes.
+        rss_growth (int): How much the peak resident memory of the process grew during the span, in bytes.
+        rows_in (int or None): The number of rows the span read.
+        rows_out (int or None): The number of rows the span produced.
+        children (list): The spans opened inside this span.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0
+        self.cpu_time = 0
+        self.peak_memory = None
+        self.peak_rss = 0
+        self.rss_growth = 0
+        self.rows_in = None
+        self.rows_out = None
+        self.children = []
+
+    def to_dict(self):
+        """Return the span and its nested spans as a dictionary."""
+        rows = self.rows_out if self.rows_out is not None else self.rows_in
+        return {
+            'name': self.name,
+            'wall_time': round(self.wall_time, 4),
+            'cpu_time': round(self.cpu_time, 4),
+            'peak_memory_mb': round(self.peak_memory / 1024 ** 2, 2) if self.peak_memory is not None else None,
+            'peak_rss_mb': round(self.peak_rss / 1024 ** 2, 2),
+            'rss_growth_mb': round(self.rss_growth / 1024 ** 2, 2),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rows_per_second': round(rows / self.wall_time, 2) if rows is not None and self.wall_time else None,
+            'children': [child.to_dict() for child in self.children]
+            }
+
+def record_rows(rows_in=None, rows_out=None):
+    """
+    Record the input and output row counts of the innermost open span. Does nothing outside a span.
+
+    Parameters:
+        rows_in (int, optional): The number of rows read.
+        rows_out (int, optional): The number of rows produced.
+    """
+    if not stack:
+        return
+    if rows_in is not None:
+        stack[-1].rows_in = int(rows_in)
+    if rows_out is not None:
+        stack[-1].rows_out = int(rows_out)
+
+def peak_rss():
+    """
+    Return the peak resident memory of the process.
+
+    Returns:
+        int: The peak resident set size, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # ru_maxrss is in kilobytes on Linux
+
+def current_rss():
+    """
+    Return the current resident memory of the process, or its peak where the current one can't be read.
+
+    Returns:
+        int: The resident set size, in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
+
+def reset_memory_peak():
+    """
+    Restart the peak of memory traced by tracemalloc, keeping the peak reached so far in the open spans.
+    Does nothing when tracemalloc isn't tracing.
+    """
+    if not tracemalloc.is_tracing():
+        return
+    peak = tracemalloc.get_traced_memory()[1]
+    for span in stack:
+        if span.peak_memory is not None:
+            span.peak_memory = max(span.peak_memory, peak)
+    tracemalloc.reset_peak()
+
+@contextmanager
+def trace_span(name, profile=False, memory=False):
+    """
+    Open a span that measures the wall and CPU time, the memory and the rows of a section of a run.
+
+    Spans opened inside another span are nested in it. When the outermost span ends the whole trace is written
+    as JSON to 'Traces/<name>_<date>.json'. The memory of a span is measured by default from the peak resident
+    memory of the process, which costs nothing.
+
+    If 'profile' is True, or the PROFILE environment variable is set to 1, the run is profiled with cProfile and
+    its stats are written to 'Traces/<name>_<date>.prof'. Only the outermost span that asks for it owns the
+    profiler; the spans nested in it are included in its stats.
+
+    If 'memory' is True, or the TRACE_MEMORY environment variable is set to 1, the allocations are also traced
+    with tracemalloc to report the peak of Python memory of every span. It is much slower, so it is opt-in.
+
+    Parameters:
+        name (str): The name of the span.
+        profile (bool, optional): Whether to profile the span with cProfile. Defaults to False.
+        memory (bool, optional): Whether to trace the memory allocations of the span. Defaults to False.
+
+    Yields:
+        Span: The open span.
+    """
+    global profiler
+
+    span = Span(name)
+    parent = stack[-1] if stack else None
+
+    started_tracing = False
+    if (memory or os.environ.get('TRACE_MEMORY') == '1') and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracing = True
+    if tracemalloc.is_tracing(): # Keep the peak of the open spans before restarting the peak for the new span
+        reset_memory_peak()
+        span.peak_memory = 0
+
+    owns_profiler = False
+    if (profile or os.environ.get('PROFILE') == '1') and profiler is None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        owns_profiler = True
+
+    stack.append(span)
+    date = datetime.now()
+    rss_start = peak_rss()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield span
+    finally:
+        span.wall_time = time.perf_counter() - wall_start
+        span.cpu_time = time.process_time() - cpu_start
+        span.peak_rss = peak_rss()
+        span.rss_growth = span.peak_rss - rss_start
+        if span.peak_memory is not None and tracemalloc.is_tracing():
+            span.peak_memory = max(span.peak_memory, tracemalloc.get_traced_memory()[1])
+        stack.pop()
+
+        if owns_profiler:
+            profiler.disable()
+            os.makedirs(trace_dir, exist_ok=True)
+            profiler.dump_stats(f'{trace_dir}/{name}_{date:%Y%m%d_%H%M%S}.prof')
+            profiler = None
+
+        if started_tracing:
+            tracemalloc.stop()
+
+        if parent is not None:
+            parent.children.append(span)
+            if parent.peak_memory is not None and span.peak_memory is not None:
+                parent.peak_memory = max(parent.peak_memory, span.peak_memory)
+        else:
+            write_trace(span, date)
+
+def write_trace(span, date):
+    """
+    Write the trace of a run as JSON.
+
+    Parameters:
+        span (Span): The root span of the run.
+        date (datetime.datetime): The start date of the run.
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+    trace = {'run': span.name, 'started': date.isoformat(timespec='seconds'), 'trace': span.to_dict()}
+
+    with open(f'{trace_dir}/{span.name}_{date:%Y%m%d_%H%M%S}.json', 'w', encoding='utf-8') as f:
+        json.dump(trace, f, indent=2)
@@ -57,16 +57,20 @@ def scrape_developer(soup):
     except AttributeError:
         return None
     
-def make_requests(url):
+def make_requests(url, timeout=30):
     """
     Get soup object to perform web scraping
     """
     try:
-        req = requests.get(url)
-        assert req.status_code == 200, f'There is a problem with the url {url}.'
+        req = requests.get(url, timeout=timeout)
+        assert req.status_code == 200, f'There is a problem with the url {url} (status {req.status_code}).'
         soup = BeautifulSoup(req.text, 'lxml')
         return soup
-    except AssertionError:
+    except AssertionError as error:
+        print(error)
+        return None
+    except requests.RequestException as error:
+        print(f'There is a problem with the url {url} ({error}).')
         return None
 
 def scrape_missing_row(df):
@@ -1,12 +1,94 @@
 import pandas as pd
 import numpy as np
+import os
+import sys
 import time
+import hashlib
+import unicodedata
+import torch
 from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
 from etl_functions import calc_ejecution_time
-from langdetect import detect, LangDetectException
-from googletrans import Translator
-from requests.exceptions import ReadTimeout
-from httpcore._exceptions import ReadTimeout as ReadTimeout2
+from translation_functions import TranslationStage
+from profiling_functions import trace_span, record_rows
+
+class SentimentCache:
+    """
+    A persistent cache of translation and sentiment results keyed by the content of the review.
+
+    Every entry is stored under a hash of the normalised review text, the model id and the translation backend id,
+    so duplicated reviews are only translated and scored once, both inside a run and across runs, and the results
+    of a stand-in or offline translation backend are never served to a run with another backend.
+
+    Parameters:
+        path (str, optional): The path of the Parquet file that stores the cache.
+            Defaults to 'CleanDatasets/sentiment_cache.parquet'.
+        model_id (str, optional): The id of the sentiment analysis model the results belong to.
+            Defaults to 'cardiffnlp/twitter-roberta-base-sentiment-latest'.
+        translation_id (str, optional): The id of the translation backend the results belong to.
+            Defaults to 'GoogleTranslateBackend'.
+
+    Attributes:
+        entries (dict): A dictionary mapping every key to a (language, translation, sentiment) tuple.
+        hits (int): Number of reviews served from entries stored in previous runs.
+        duplicates (int): Number of reviews served from another review of the same run.
+        misses (int): Number of reviews that had to be translated and scored.
+    """
+    columns = ['key', 'language', 'translation', 'sentiment_analysis']
+
+    def __init__(self, path='CleanDatasets/sentiment_cache.parquet', model_id='cardiffnlp/twitter-roberta-base-sentiment-latest',
+                 translation_id='GoogleTranslateBackend'):
+        self.path = path
+        self.model_id = model_id
+        self.translation_id = translation_id
+        self.entries = {}
+        self.hits = 0
+        self.duplicates = 0
+        self.misses = 0
+
+        if os.path.exists(self.path):
+            df = pd.read_parquet(self.path)
+            self.entries = {row.key: (row.language, row.translation, int(row.sentiment_analysis)) for row in df.itertuples()}
+
+    def make_key(self, text):
+        """
+        Build the cache key of a review.
+
+        Parameters:
+            text (str): The review text.
+
+        Returns:
+            str: The hexadecimal hash of the model id, the translation backend id and the normalised review text.
+        """
+        normalised = ' '.join(unicodedata.normalize('NFC', str(text)).split()) # Collapse unicode forms and whitespaces
+        return hashlib.sha256(f'{self.model_id}\x00{self.translation_id}\x00{normalised}'.encode('utf-8')).hexdigest()
+
+    def update(self, df):
+        """
+        Store the results of the reviews analyzed in the current run.
+        The reviews whose translation failed are not stored, so they are translated again in the next run.
+
+        Parameters:
+            df (pandas.DataFrame): A DataFrame with the 'review_key', 'language', 'review' (translated text),
+                'translation_failed' and 'sentiment_analysis' columns.
+        """
+        for row in df[~df['translation_failed']].itertuples():
+            self.entries[row.review_key] = (row.language, row.review, int(row.sentiment_analysis))
+
+    def sentiment(self, key):
+        return self.entries[key][2]
+
+    def save(self):
+        """Save the cache to its Parquet file."""
+        df = pd.DataFrame([(key, *values) for key, values in self.entries.items()], columns=self.columns)
+        df.to_parquet(self.path, index=False)
+
+    def report(self):
+        """Print the cache hit statistics of the current run."""
+        total = self.hits + self.duplicates + self.misses
+        served = self.hits + self.duplicates
+        ratio = round(100 * served / total, 2) if total else 0
+        print(f"Sentiment cache: {served}/{total} reviews served from cache ({ratio}%), "
+              f"{self.hits} from previous runs, {self.duplicates} duplicated in this run, {self.misses} analyzed")
 
 class SentimentAnalysis:
     """
@@ -19,16 +101,28 @@ class SentimentAnalysis:
     Attributes:
         df (pandas.DataFrame): A DataFrame containing user reviews.
         model_path (str): The path or name of the pre-trained model.
+        backend (str): The inference backend of the model, 'fp32' or 'int8'.
         model (transformers.AutoModelForSequenceClassification): The sentiment analysis model.
+        load_time (float): The seconds spent loading (and quantizing) the model.
         tokenizer (transformers.AutoTokenizer): The model's tokenizer.
+        cache (SentimentCache): The persistent cache of translation and sentiment results.
+        translation (TranslationStage): The stage that detects the language of the reviews and translates them.
+        max_chunk_tokens (int): The maximum number of text tokens the model accepts in a single input.
+        chunk_overlap (int): The number of tokens shared by consecutive windows of a long text.
+        batch_size (int): The number of texts or windows fed to the model at once.
+        label_ids (dict): A dictionary mapping the 'neg', 'neu' and 'pos' keys to the model output indices.
 
     Methods:
         sentiment_analysis: Performs sentiment analysis on user reviews and adds the sentiment scores to the DataFrame.
-        classify_large_text: Handles sentiment analysis for long texts.
+        split_token_windows: Splits the token ids of a long text into windows that fit in the model.
+        classify_large_texts: Handles sentiment analysis for a list of long texts in batches.
+        classify_large_text: Handles sentiment analysis for a single long text.
         set_label: Assigns a sentiment label based on sentiment scores.
         run: Executes the sentiment analysis and saves the results to a CSV file.
     """
-    def __init__(self, model_path='cardiffnlp/twitter-roberta-base-sentiment-latest', df_path='CleanDatasets/users_reviews.csv'):
+    def __init__(self, model_path='cardiffnlp/twitter-roberta-base-sentiment-latest', df_path='CleanDatasets/users_reviews.csv',
+                 cache_path='CleanDatasets/sentiment_cache.parquet', chunk_overlap=0, batch_size=32, translation=None,
+                 backend='fp32'):
         """
         Initializes the SentimentAnalysis object.
 
@@ -37,24 +131,61 @@ class SentimentAnalysis:
                 Defaults to 'cardiffnlp/twitter-roberta-base-sentiment-latest'.
             df_path (str, optional): The path to the CSV file containing user reviews data.
                 Defaults to 'Datasets/users_reviews.csv'.
+            cache_path (str, optional): The path to the Parquet file of the sentiment cache.
+                Defaults to 'CleanDatasets/sentiment_cache.parquet'.
+            chunk_overlap (int, optional): The number of tokens shared by consecutive windows of a long text.
+                Defaults to 0.
+            batch_size (int, optional): The number of texts or windows fed to the model at once.
+                Defaults to 32.
+            translation (TranslationStage, optional): The translation stage, for example one with a local or offline backend.
+                Defaults to a 'TranslationStage' with the Google Translate backend.
+            backend (str, optional): The inference backend, 'fp32' for the original model or 'int8' for the model with
+                its linear layers dynamically quantized to int8, which runs faster on CPU. The int8 model takes
+                longer to load, because the fp32 model is loaded first and then quantized.
+                Defaults to 'fp32'.
         """
+        assert backend in ('fp32', 'int8'), f'Unknown backend {backend}.'
         self.df = pd.read_csv(df_path)
         self.model_path = model_path
+        self.backend = backend
+
+        start = time.perf_counter()
         self.model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
+        if self.backend == 'int8':
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model.eval()
+        self.load_time = time.perf_counter() - start
+
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        self.translation = translation if translation is not None else TranslationStage()
+        # The quantized model can return different labels, so its results are cached apart from the original model
+        model_id = self.model_path if self.backend == 'fp32' else f'{self.model_path}@{self.backend}'
+        self.cache = SentimentCache(cache_path, model_id=model_id, translation_id=self.translation.backend.identifier)
+
+        self.max_chunk_tokens = min(self.tokenizer.model_max_length, 512) - self.tokenizer.num_special_tokens_to_add()
+        assert 0 <= chunk_overlap < self.max_chunk_tokens, f'chunk_overlap must be lower than {self.max_chunk_tokens}.'
+        self.chunk_overlap = chunk_overlap
+        self.batch_size = batch_size
+        self.label_ids = {label.lower()[:3]: index for index, label in self.model.config.id2label.items()}
     
-    def sentiment_analysis(self):
+    def sentiment_analysis(self, df):
         """
         Perform sentiment analysis on user reviews and update the DataFrame with sentiment labels.
         This method uses a pre-trained sentiment analysis model to classify user reviews into three categories:
         Positive, Neutral, or Negative. The sentiment labels are added to the DataFrame under the 'sentiment_analysis' column.
-        If a RuntimeError or IndexError occurs during sentiment analysis, it falls back to using the 'classify_large_text'
-        method to handle long texts.
-        If a ValueError occurs, a default sentiment label of 1 (Neutral) is assigned.
+        Reviews that fit in the model are classified in batches with the pipeline, while reviews with more than 512
+        tokens are classified together with the 'classify_large_texts' method.
+        Empty reviews ('1') get a default sentiment label of 1 (Neutral).
+
+        Parameters:
+            df (pandas.DataFrame): A DataFrame with the reviews to analyze.
+
+        Returns:
+            pandas.DataFrame: The same DataFrame with the 'sentiment_analysis' column.
         """
         nlp = pipeline('sentiment-analysis', model=self.model, tokenizer=self.tokenizer)
 
-        self.df['sentiment_analysis'] = '--'
+        df['sentiment_analysis'] = 1
 
         mapping = {
             'positive': 2,
@@ -62,54 +193,88 @@ class SentimentAnalysis:
             'negative': 0
             }
 
-        for i, row in self.df.iterrows():
-            text = row.review
+        texts = df['review'].astype(str)
+        input_ids = self.tokenizer(texts.tolist(), add_special_tokens=False)['input_ids']
 
-            if text == '1':
-                self.df.loc[i, 'sentiment_analysis'] = 1
-                continue
+        is_empty = (texts == '1').to_numpy()
+        is_large = np.array([len(ids) > self.max_chunk_tokens for ids in input_ids], dtype=bool)
+        is_short = ~is_empty & ~is_large
 
-            try:
-                label = nlp(text)[0]['label']
-                self.df.loc[i, 'sentiment_analysis'] = mapping.get(label)
-            except (RuntimeError, IndexError): # Capture texts with more than 512 words
-                self.df.loc[i, 'sentiment_analysis'] = int(self.classify_large_text(text))
+        if is_short.any():
+            results = nlp(texts[is_short].tolist(), batch_size=self.batch_size, truncation=True)
+            df.loc[is_short, 'sentiment_analysis'] = [mapping.get(result['label']) for result in results]
 
-        self.df.drop(columns=['review'], inplace=True)
-        
-    def classify_large_text(self, text):
+        if is_large.any(): # Texts with more than 512 tokens
+            large_ids = [ids for ids, large in zip(input_ids, is_large) if large]
+            df.loc[is_large, 'sentiment_analysis'] = self.classify_large_texts(large_ids)
+
+        return df
+
+    def split_token_windows(self, input_ids):
         """
-        Handles sentiment analysis on long texts by dividing them into smaller chunks of text and
-        performing sentiment analysis on each chunk. The sentiment scores (positive, neutral, and negative) for
-        each chunk are averaged to produce an overall sentiment score for the entire text.
+        Split the token ids of a long text into windows that fit in the model.
+
+        Consecutive windows share 'chunk_overlap' tokens, so the context around the cuts is not lost.
 
         Parameters:
-            text (str): The long text to analyze.
+            input_ids (list): The token ids of the text, without special tokens.
 
         Returns:
-            int: The sentiment label (0 for Negative, 1 for Neutral, 2 for Positive) based on the averaged scores.
+            list: A list of token ids windows of at most 'max_chunk_tokens' tokens.
+        """
+        step = self.max_chunk_tokens - self.chunk_overlap
+        last_start = max(len(input_ids) - self.chunk_overlap, 1)
+
+        return [input_ids[i:i + self.max_chunk_tokens] for i in range(0, last_start, step)]
+
+    def classify_large_texts(self, texts_ids):
+        """
+        Handles sentiment analysis on long texts by dividing them into windows of tokens and performing
+        sentiment analysis on each window. The windows of all the texts are fed directly to the model in batches,
+        and the sentiment scores (positive, neutral, and negative) of the windows of every text are averaged
+        to produce an overall sentiment score for the entire text.
+
+        Parameters:
+            texts_ids (list): A list with the token ids (without special tokens) of every long text to analyze.
+
+        Returns:
+            list: The sentiment labels (0 for Negative, 1 for Neutral, 2 for Positive) based on the averaged scores.
         """
-        nlp = pipeline('sentiment-analysis', model=self.model, tokenizer=self.tokenizer, top_k=3)
+        windows = [(text, window) for text, input_ids in enumerate(texts_ids) for window in self.split_token_windows(input_ids)]
+        windows.sort(key=lambda x: len(x[1])) # Batch windows with similar lengths to reduce padding
+
+        scores = np.zeros((len(texts_ids), self.model.config.num_labels))
+        counts = np.zeros(len(texts_ids))
+
+        with torch.inference_mode():
+            for i in range(0, len(windows), self.batch_size):
+                batch = windows[i:i + self.batch_size]
+                inputs = self.tokenizer.pad(
+                    {'input_ids': [self.tokenizer.build_inputs_with_special_tokens(window) for _, window in batch]},
+                    return_tensors='pt')
+                probabilities = torch.softmax(self.model(**inputs).logits, dim=-1).numpy()
+
+                for (text, _), probability in zip(batch, probabilities):
+                    scores[text] += probability
+                    counts[text] += 1
 
-        tokenized_text = self.tokenizer(text)
-        input_ids = tokenized_text['input_ids']
+        avg_scores = scores / counts[:, None]
 
-        text_chunks = [input_ids[i:i + 510] for i in range(0, len(input_ids), 510)]
-        
-        scores = {'neu': [], 'neg': [], 'pos': []}
+        return [int(self.set_label({key: avg[index] for key, index in self.label_ids.items()})) for avg in avg_scores]
 
-        for chunk in text_chunks:
-            partial_text = self.tokenizer.decode(chunk, skip_special_tokens=True)
-            try:    
-                result = nlp(partial_text)[0]
-                for i, key in enumerate(scores.keys()):
-                    scores[key].append(result[i]['score'])
-            except IndexError:
-                scores['neu'].append(0.6)
+    def classify_large_text(self, text):
+        """
+        Handles sentiment analysis on a single long text with the 'classify_large_texts' method.
+
+        Parameters:
+            text (str): The long text to analyze.
 
-        avg_scores = {key: np.mean(val) for key, val in scores.items()}
+        Returns:
+            int: The sentiment label (0 for Negative, 1 for Neutral, 2 for Positive) based on the averaged scores.
+        """
+        input_ids = self.tokenizer(text, add_special_tokens=False)['input_ids']
 
-        return self.set_label(avg_scores)
+        return self.classify_large_texts([input_ids])[0]
 
     def set_label(self, avg_scores):
         """
@@ -125,45 +290,135 @@ class SentimentAnalysis:
 
         return label_index
 
-    def translate_text(self):
+    def translate_text(self, df):
         """
         Translate non-English text reviews in the DataFrame to English.
 
-        This method iterates through the DataFrame's rows, detects the language of each review using the langdetect
-        library, and translates non-English reviews to English using the googletrans library. The translated text is
-        then updated in the DataFrame.
-        """
-        translator = Translator()
-
-        for i, row in self.df.iterrows():
-            text = row.review
-            try:
-                detected_language = detect(text)
-                if detected_language != 'en':
-                    time.sleep(0.3)
-                    translated_text = translator.translate(text, src=detected_language, dest='en').text
-                    self.df.loc[i, 'review'] = translated_text
-            except (LangDetectException, ReadTimeout, ReadTimeout2, TypeError):
-                continue
+        This method detects the language of all the reviews in bulk with the langdetect library, and sends only the
+        non-English reviews to the translation stage, which translates them concurrently with its backend. The
+        detected language and the translated text are then updated in the DataFrame.
+
+        Parameters:
+            df (pandas.DataFrame): A DataFrame with the reviews to translate.
+
+        Returns:
+            pandas.DataFrame: The same DataFrame with the translated 'review' column, the 'language' column and
+                the 'translation_failed' column.
+        """
+        languages, translated, failed = self.translation.run(df['review'].tolist())
+
+        df['language'] = languages
+        df['review'] = translated
+        df['translation_failed'] = failed
+
+        return df
     
     def run(self, save_path):
         """
         Executes the sentiment analysis and save the results to a CSV file.
 
+        Only the reviews whose content is not already in the cache are translated and analyzed, the rest of them
+        take their sentiment label from the cache. The reviews whose translation failed are labelled from their
+        original text in this run, but they are left out of the cache.
+
         Parameters:
             save_path (str): The path to save the results CSV file.
         """
-        self.translate_text()
-        self.sentiment_analysis()
+        self.df['review_key'] = self.df['review'].apply(self.cache.make_key)
+
+        cached = self.df['review_key'].isin(set(self.cache.entries))
+        pending = self.df[~cached].drop_duplicates(subset='review_key').copy()
+
+        self.cache.misses = len(pending)
+        self.cache.hits = int(cached.sum())
+        self.cache.duplicates = len(self.df) - self.cache.misses - self.cache.hits
+
+        record_rows(rows_in=len(self.df))
+
+        sentiments = {}
+        if not pending.empty:
+            with trace_span('translate_text'):
+                record_rows(rows_in=len(pending))
+                pending = self.translate_text(pending)
+            with trace_span('sentiment_analysis'):
+                record_rows(rows_in=len(pending))
+                pending = self.sentiment_analysis(pending)
+            self.cache.update(pending)
+            self.cache.save()
+            sentiments = dict(zip(pending['review_key'], pending['sentiment_analysis'].astype(int)))
+
+        self.df['sentiment_analysis'] = self.df['review_key'].apply(lambda key: sentiments[key] if key in sentiments else self.cache.sentiment(key))
+        self.df.drop(columns=['review', 'review_key'], inplace=True)
+        self.cache.report()
+
+        record_rows(rows_out=len(self.df))
         self.df.to_csv(save_path, index=False)
         print('Saved')
 
 @calc_ejecution_time
-def main():
+def compare_backends(model_path='cardiffnlp/twitter-roberta-base-sentiment-latest', df_path='CleanDatasets/users_reviews.csv',
+                     sample_size=1000, seed=42):
+    """
+    Compare the int8 quantized backend against the original fp32 model on a sample of the reviews.
+
+    The sample is labelled with the fp32 model, which is the reference, and then with the int8 model, to measure
+    the label agreement between them, the model load time and the time per review of every backend.
+    The model is loaded once before the timings, so the download from the Hugging Face hub isn't counted
+    in the load time of the fp32 model.
+
+    Parameters:
+        model_path (str, optional): The path or name of the pre-trained sentiment analysis model.
+            Defaults to 'cardiffnlp/twitter-roberta-base-sentiment-latest'.
+        df_path (str, optional): The path to the CSV file containing user reviews data.
+            Defaults to 'CleanDatasets/users_reviews.csv'.
+        sample_size (int, optional): The number of reviews of the sample. Defaults to 1000.
+        seed (int, optional): The random seed of the sample. Defaults to 42.
+
+    Returns:
+        dict: The label agreement, the agreement for every fp32 label, the load and per review times and the speedups.
+    """
+    labels = {0: 'Negative', 1: 'Neutral', 2: 'Positive'}
+    results = {}
+    times = {}
+
+    # Warm the local cache of the hub
+    AutoTokenizer.from_pretrained(model_path)
+    AutoModelForSequenceClassification.from_pretrained(model_path)
+
+    for backend in ('fp32', 'int8'):
+        analysis = SentimentAnalysis(model_path=model_path, df_path=df_path, backend=backend)
+        sample = analysis.df[analysis.df['review'] != '1']
+        sample = sample.sample(min(sample_size, len(sample)), random_state=seed)[['review']].copy()
+
+        start = time.perf_counter()
+        results[backend] = analysis.sentiment_analysis(sample)['sentiment_analysis'].astype(int)
+        times[backend] = {'load_time': analysis.load_time, 'review_time': (time.perf_counter() - start) / len(sample)}
+
+    agree = results['fp32'] == results['int8']
+
+    report = {
+        'sample_size': len(agree),
+        'agreement': round(agree.mean(), 4),
+        'agreement_by_label': {labels[label]: round(agree[results['fp32'] == label].mean(), 4) for label in sorted(results['fp32'].unique())},
+        'fp32_load_time': round(times['fp32']['load_time'], 2),
+        'int8_load_time': round(times['int8']['load_time'], 2),
+        'fp32_ms_per_review': round(1000 * times['fp32']['review_time'], 2),
+        'int8_ms_per_review': round(1000 * times['int8']['review_time'], 2),
+        'speedup': round(times['fp32']['review_time'] / times['int8']['review_time'], 2)
+        }
+
+    print(report)
+    return report
+
+@calc_ejecution_time
+def main(backend='fp32'):
     """Execute sentiment analysis functions."""
     save_path = 'CleanDatasets/users_sentiment.csv'
-    analysis = SentimentAnalysis()
+    analysis = SentimentAnalysis(backend=backend)
     analysis.run(save_path)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if '--compare-backends' in sys.argv:
+        compare_backends()
+    else:
+        main(backend='int8' if '--int8' in sys.argv else 'fp32')
\ No newline at end of file
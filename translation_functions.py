@@ -0,0 +1,245 @@
+import asyncio, inspect, time
+from abc import ABC, abstractmethod
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from langdetect import DetectorFactory, detect, LangDetectException
+from googletrans import Translator
+from transformers import pipeline
+from requests.exceptions import ReadTimeout
+from httpcore._exceptions import ReadTimeout as ReadTimeout2
+
+def detect_chunk_languages(texts):
+    """
+    Detect the language of every text in a chunk with langdetect.
+
+    Parameters:
+        texts (list): A list of texts.
+
+    Returns:
+        list: The detected language codes, None for the texts where the language can't be detected.
+    """
+    DetectorFactory.seed = 0 # Make the detection deterministic
+
+    languages = []
+    for text in texts:
+        try:
+            languages.append(detect(text))
+        except LangDetectException:
+            languages.append(None)
+    return languages
+
+def detect_languages(texts, n_jobs=1, chunk_size=2000):
+    """
+    Detect the language of a list of texts in bulk.
+    Every distinct text is detected only once, and the distinct texts are split in chunks that can be
+    processed by several worker processes.
+
+    Parameters:
+        texts (list): A list of texts.
+        n_jobs (int, optional): The number of worker processes. Defaults to 1 (no extra processes).
+        chunk_size (int, optional): The number of texts sent to a worker at once. Defaults to 2000.
+
+    Returns:
+        list: The detected language codes in the same order as the texts, None where the language can't be detected.
+    """
+    texts = [str(text) for text in texts]
+    unique_texts = list(dict.fromkeys(texts))
+    chunks = [unique_texts[i:i + chunk_size] for i in range(0, len(unique_texts), chunk_size)]
+
+    if n_jobs == 1:
+        results = [detect_chunk_languages(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(detect_chunk_languages, chunks))
+
+    languages = dict(zip(unique_texts, chain.from_iterable(results)))
+
+    return [languages[text] for text in texts]
+
+class RateLimiter:
+    """
+    An asynchronous rate limiter that spaces out the requests sent to a translation backend.
+
+    Parameters:
+        rate (float or None): The maximum number of requests per second. None disables the limit.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        """Wait until the next request is allowed."""
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class TranslationBackend(ABC):
+    """
+    Base class of the translation backends used by the 'TranslationStage'.
+
+    Attributes:
+        max_batch_size (int): The maximum number of texts the backend translates in a single request.
+        errors (tuple): The exceptions that make the stage keep the original texts of a request.
+        identifier (str): The id of the backend, stored in the sentiment cache keys so the results of
+            different backends are never mixed.
+
+    Methods:
+        translate_batch: Translates a list of texts written in the same language to English.
+    """
+    max_batch_size = 1
+    errors = ()
+
+    @property
+    def identifier(self):
+        return type(self).__name__
+
+    @abstractmethod
+    async def translate_batch(self, texts, src):
+        """
+        Translate a list of texts written in the same language to English.
+
+        Parameters:
+            texts (list): The texts to translate.
+            src (str): The language code of the texts.
+
+        Returns:
+            list: The translated texts, in the same order.
+        """
+
+class GoogleTranslateBackend(TranslationBackend):
+    """
+    A translation backend that sends the texts to Google Translate through the googletrans library.
+    googletrans sends one request per text even when it's given a list, so every text is a batch of its own
+    and every request is charged to the rate limit of the stage.
+    """
+    max_batch_size = 1
+    errors = (ReadTimeout, ReadTimeout2, TypeError)
+
+    def __init__(self):
+        self.translator = Translator()
+
+    async def translate_batch(self, texts, src):
+        result = await asyncio.to_thread(self.translator.translate, texts, src=src, dest='en')
+        if inspect.isawaitable(result): # Newer googletrans versions are asynchronous
+            result = await result
+        return [translated.text for translated in result]
+
+class MarianTranslationBackend(TranslationBackend):
+    """
+    An offline translation backend that runs a MarianMT model from Hugging Face locally.
+
+    Parameters:
+        model_path (str, optional): The path or name of the translation model.
+            Defaults to 'Helsinki-NLP/opus-mt-mul-en'.
+        batch_size (int, optional): The number of texts translated at once. Defaults to 16.
+    """
+    def __init__(self, model_path='Helsinki-NLP/opus-mt-mul-en', batch_size=16):
+        self.model_path = model_path
+        self.max_batch_size = batch_size
+        self.nlp = pipeline('translation', model=model_path)
+
+    @property
+    def identifier(self):
+        return f'{type(self).__name__}:{self.model_path}'
+
+    async def translate_batch(self, texts, src):
+        result = await asyncio.to_thread(self.nlp, texts, batch_size=self.max_batch_size, truncation=True)
+        return [translated['translation_text'] for translated in result]
+
+class LocalTranslationBackend(TranslationBackend):
+    """
+    A local stand-in backend that returns the texts unchanged after an optional simulated latency.
+    Useful to run and time the pipeline without network access.
+
+    Parameters:
+        latency (float, optional): The seconds every request takes. Defaults to 0.
+        batch_size (int, optional): The maximum number of texts per request. Defaults to 25.
+    """
+    def __init__(self, latency=0, batch_size=25):
+        self.latency = latency
+        self.max_batch_size = batch_size
+
+    async def translate_batch(self, texts, src):
+        await asyncio.sleep(self.latency)
+        return list(texts)
+
+class TranslationStage:
+    """
+    Detects the language of a list of texts in bulk and translates the non-English ones to English.
+
+    The texts are grouped by language and split in batches of the backend 'max_batch_size', then the
+    batches are sent concurrently to the backend under a rate limit.
+
+    Parameters:
+        backend (TranslationBackend, optional): The translation backend. Defaults to 'GoogleTranslateBackend'.
+        rate (float, optional): The maximum number of requests per second. Defaults to 3.
+        max_concurrency (int, optional): The maximum number of requests in flight. Defaults to 4.
+        n_jobs (int, optional): The number of worker processes used for language detection. Defaults to 1.
+    """
+    def __init__(self, backend=None, rate=3, max_concurrency=4, n_jobs=1):
+        self.backend = backend if backend is not None else GoogleTranslateBackend()
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.n_jobs = n_jobs
+
+    def run(self, texts):
+        """
+        Detect the language of the texts and translate the non-English ones.
+
+        Parameters:
+            texts (list): A list of texts.
+
+        Returns:
+            tuple: The detected languages, the texts translated to English (original texts if they were already
+                in English, the language could not be detected or the translation request failed) and whether
+                the translation request of every text failed.
+        """
+        texts = [str(text) for text in texts]
+        languages = detect_languages(texts, n_jobs=self.n_jobs)
+        translated, failed = asyncio.run(self.translate(texts, languages))
+
+        return languages, translated, failed
+
+    async def translate(self, texts, languages):
+        """
+        Send the non-English texts to the backend concurrently.
+
+        Parameters:
+            texts (list): A list of texts.
+            languages (list): The language code of every text.
+
+        Returns:
+            tuple: The texts translated to English and whether the translation request of every text failed.
+        """
+        limiter = RateLimiter(self.rate)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        translated = list(texts)
+        failed = [False] * len(texts)
+
+        groups = {}
+        for i, language in enumerate(languages):
+            if language is not None and language != 'en':
+                groups.setdefault(language, []).append(i)
+
+        batch_size = self.backend.max_batch_size
+        batches = [(language, indices[i:i + batch_size]) for language, indices in groups.items() for i in range(0, len(indices), batch_size)]
+
+        async def translate_batch(language, indices):
+            async with semaphore:
+                await limiter.wait()
+                try:
+                    result = await self.backend.translate_batch([texts[i] for i in indices], src=language)
+                except self.backend.errors: # Keep the original texts and mark them to be retried in the next run
+                    for i in indices:
+                        failed[i] = True
+                    return
+            for i, text in zip(indices, result):
+                translated[i] = text
+
+        await asyncio.gather(*(translate_batch(language, indices) for language, indices in batches))
+
+        return translated, failed
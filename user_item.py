@@ -1,11 +1,16 @@
 import pandas as pd
 import numpy as np
+import os, sys, time
 import tensorflow as tf
 import tensorflow_recommenders as tfrs
 from tensorflow.python.ops.numpy_ops import np_config
 from typing import Dict, Text
+from etl_functions import calc_ejecution_time, save_serving_dataset
+from profiling_functions import record_rows
 
 path = 'Models/collaborative_filtering'
+state_path = 'Models/collaborative_filtering_state'
+recommendations_path = '_src/ApiDatasets/user_recommendations.parquet'
 
 np_config.enable_numpy_behavior()
 
@@ -19,6 +24,9 @@ class GamesModel(tfrs.Model):
     Parameters:
         unique_games_ids (list): A list of unique games.
         unique_users_ids (list): A list of unique user IDs.
+        games (tf.data.Dataset): The games used as candidates by the retrieval metrics.
+        game_embeddings (numpy.ndarray, optional): Initial game embeddings, one row more than 'unique_games_ids' (OOV row first).
+        user_embeddings (numpy.ndarray, optional): Initial user embeddings, one row more than 'unique_users_ids' (OOV row first).
 
     Attributes:
         games_model (tf.keras.Model): A sequential model for learning game embeddings.
@@ -34,7 +42,7 @@ class GamesModel(tfrs.Model):
     Date:
         [09/29/23]     
     """
-    def __init__(self, unique_games_ids, unique_users_ids, games):
+    def __init__(self, unique_games_ids, unique_users_ids, games, game_embeddings=None, user_embeddings=None):
         super().__init__()
 
         self.unique_games_ids = unique_games_ids
@@ -46,7 +54,7 @@ class GamesModel(tfrs.Model):
     # Define the 'games_model' and 'user_model' which learns embeddings for game titles and users IDs.
     # It uses two layers:
     # 1. 'StringLookup' layer converts data to integer indices.
-    # 2. 'Embedding' layer creates dense embeddings for these data.
+    # 2. 'Embedding' layer creates dense embeddings for these data, starting from the given embeddings when warm-starting.
 
         self.games_model: tf.keras.Model = tf.keras.Sequential([
             tf.keras.layers.StringLookup(
@@ -59,6 +67,9 @@ class GamesModel(tfrs.Model):
                 vocabulary=self.unique_users_ids, mask_token=None),
             tf.keras.layers.Embedding(
                 len(self.unique_users_ids) + 1, output_dim=16)])
+
+        set_embeddings(self.games_model.layers[1], game_embeddings)
+        set_embeddings(self.user_model.layers[1], user_embeddings)
         
     # This task is responsible for retrieving top-k game recommendations.
     # It uses the 'FactorizedTopK' metric to evaluate recommendations.
@@ -85,63 +96,269 @@ class GamesModel(tfrs.Model):
         #Create positive game embeddings (games that the user has and rated)
         positive_game_embeddings = self.games_model(features["title"])
 
-        return self.task(user_embeddings, positive_game_embeddings)
+        # The FactorizedTopK metrics score every candidate, so they are only computed outside training
+        return self.task(user_embeddings, positive_game_embeddings, compute_metrics=not training)
+
+def set_embeddings(layer, embeddings):
+    """
+    Build an embedding layer and load the given embeddings as its weights. Does nothing if there are none.
+
+    The embeddings are set as weights instead of a constant initializer, so they aren't stored in the layer
+    config and in the metadata of the saved models.
+
+    Parameters:
+        layer (tf.keras.layers.Embedding): The embedding layer.
+        embeddings (numpy.ndarray or None): The embeddings, one row per index of the layer.
+    """
+    if embeddings is None:
+        return
+    layer.build((None,))
+    layer.set_weights([embeddings])
 
-def train_model(data:dict):
+def interactions_dataset(df:pd.DataFrame):
     """
-    Train a recommendation model using the provided data and save it.
+    Convert the interactions to a tensorflow dataset with the 'user_id' and 'title' keys.
+
+    Parameters:
+        df (pandas.DataFrame): The interactions, with the 'user_id' and 'to_recommend' columns.
+
+    Returns:
+        tf.data.Dataset: The interactions dataset.
     """
     #Convert data to tensorflow dataset
-    data = tf.data.Dataset.from_tensor_slices(data)
+    data = tf.data.Dataset.from_tensor_slices({name: value.to_numpy(dtype=str) for name, value in df[['user_id', 'to_recommend']].items()})
     #Change dataset keys names to be more specific
-    dataset = dataset.map(lambda x:
+    dataset = data.map(lambda x:
                     {'user_id':x['user_id'],
-                    'title':x['to_recommend']})
-    
-    games = dataset.map(lambda x: x['title'])
-
-    #Set a random seed to shuffle our dataset and separate the train data
-    tf.random.set_seed(42)
-    shuffled = dataset.shuffle(100_000, seed=42, reshuffle_each_iteration=True)
-    train = shuffled.take(40_000)
+                    'title':x['to_recommend']}, num_parallel_calls=tf.data.AUTOTUNE)
 
-    #Create the vocabulary for our Embeddings layers
-    games_ids = dataset.batch(1_000_000).map(lambda x: x["title"])
-    unique_games_ids = np.unique(np.concatenate(list(games_ids)))
+    return dataset
 
-    users_ids = dataset.batch(1_000_000).map(lambda x:x['user_id'])
-    unique_users_ids = np.unique(np.concatenate(list(users_ids)))
+@calc_ejecution_time
+def fit_model(model, dataset, n_examples, batch_size, epochs):
+    """
+    Compile and fit the model, printing the training throughput.
 
-    #Instantiate the model and compile with an adaptative learning rate of 0.09
-    model = GamesModel(unique_games_ids, unique_users_ids, games)
+    Parameters:
+        model (GamesModel): The model to train.
+        dataset (tf.data.Dataset): The training interactions.
+        n_examples (int): The number of training interactions.
+        batch_size (int): The number of interactions per training batch.
+        epochs (int): The number of training epochs.
+    """
+    #Compile with an adaptative learning rate of 0.09
     model.compile(optimizer = tf.keras.optimizers.Adagrad(learning_rate=0.09))
 
-    #Divide the data in batches of 8192 instances
-    cached_train = train.shuffle(100_000).batch(8192).cache()
+    #Set a random seed to shuffle our dataset, cache it once and prepare the next batches while the model trains
+    tf.random.set_seed(42)
+    train = (dataset.cache()
+             .shuffle(min(n_examples, 1_000_000), seed=42, reshuffle_each_iteration=True)
+             .batch(batch_size)
+             .prefetch(tf.data.AUTOTUNE))
+
+    record_rows(rows_in=n_examples * epochs)
+    start = time.perf_counter()
+    model.fit(train, epochs=epochs)
+    elapsed = time.perf_counter() - start
+    print(f'Trained on {n_examples} interactions: {round(n_examples * epochs / elapsed)} examples per second')
 
-    model.fit(cached_train, epochs=2)
+@calc_ejecution_time
+def build_index(model, dataset, batch_size, save=True):
+    """
+    Create the retrieval index of the model for all the interactions and save it.
+
+    Parameters:
+        model (GamesModel): The trained model.
+        dataset (tf.data.Dataset): All the interactions.
+        batch_size (int): The number of interactions indexed at once.
+        save (bool, optional): Whether to save the index. Defaults to True.
 
+    Returns:
+        tfrs.layers.factorized_top_k.BruteForce: The retrieval index.
+    """
     # Create a search index to make efficient recommendations based on BruteForce (similarity between users)
     index = tfrs.layers.factorized_top_k.BruteForce(model.user_model)
 
-    index.index_from_dataset(dataset.batch(100).map(lambda x: (x['title'], model.user_model(x['user_id']))))
+    index.index_from_dataset(dataset.batch(batch_size).map(lambda x: (x['title'], model.user_model(x['user_id'])), num_parallel_calls=tf.data.AUTOTUNE))
+
+    if save:
+        index.save(path)
+        print('Model Saved')
+
+    return index
+
+def save_state(model, df:pd.DataFrame):
+    """
+    Save the vocabularies, the embeddings and the trained interactions to warm-start the next training.
+
+    Parameters:
+        model (GamesModel): The trained model.
+        df (pandas.DataFrame): All the interactions the model has been trained on.
+    """
+    os.makedirs(state_path, exist_ok=True)
+
+    np.savez(f'{state_path}/state.npz',
+             games=np.asarray(model.unique_games_ids, dtype=str),
+             users=np.asarray(model.unique_users_ids, dtype=str),
+             game_embeddings=model.games_model.layers[1].get_weights()[0],
+             user_embeddings=model.user_model.layers[1].get_weights()[0])
+    df[['user_id', 'to_recommend']].drop_duplicates().to_parquet(f'{state_path}/interactions.parquet', index=False)
+
+def grow_vocabulary(vocabulary, embeddings, ids, seed=42):
+    """
+    Append the new ids to a vocabulary and new rows to its embeddings table, keeping the indices of the old ids.
+
+    Parameters:
+        vocabulary (numpy.ndarray): The previous vocabulary.
+        embeddings (numpy.ndarray): The previous embeddings, with the OOV row first.
+        ids (numpy.ndarray): The ids present in the current interactions.
+        seed (int, optional): The random seed of the new embeddings. Defaults to 42.
+
+    Returns:
+        tuple: The grown vocabulary and embeddings.
+    """
+    new_ids = np.setdiff1d(np.unique(ids), vocabulary)
+    # New rows are initialized like the Keras 'uniform' initializer
+    new_embeddings = np.random.default_rng(seed).uniform(-0.05, 0.05, (len(new_ids), embeddings.shape[1])).astype(embeddings.dtype)
+
+    return np.concatenate((vocabulary, new_ids)), np.vstack((embeddings, new_embeddings))
 
-    index.save(path)
+def train_model(df:pd.DataFrame, batch_size=8192, epochs=2, save=True):
+    """
+    Train a recommendation model on all the provided interactions and save it.
+
+    Parameters:
+        df (pandas.DataFrame): The interactions, with the 'user_id' and 'to_recommend' columns.
+        batch_size (int, optional): The number of interactions per training batch. Defaults to 8192.
+        epochs (int, optional): The number of training epochs. Defaults to 2.
+        save (bool, optional): Whether to save the index and the training state. Defaults to True.
+
+    Returns:
+        tuple: The trained 'GamesModel' and the retrieval index.
+    """
+    #Create the vocabulary for our Embeddings layers straight from the pandas columns
+    unique_games_ids = np.unique(df['to_recommend'].to_numpy(dtype=str))
+    unique_users_ids = np.unique(df['user_id'].to_numpy(dtype=str))
+
+    games = tf.data.Dataset.from_tensor_slices(unique_games_ids)
+    dataset = interactions_dataset(df)
+
+    model = GamesModel(unique_games_ids, unique_users_ids, games)
+    fit_model(model, dataset, len(df), batch_size, epochs)
+    if save:
+        save_state(model, df)
+
+    return model, build_index(model, dataset, batch_size, save=save)
+
+def train_incremental(df:pd.DataFrame, batch_size=8192, epochs=2):
+    """
+    Warm-start the recommendation model from the previous training and fine-tune it only on the new interactions.
+
+    The previous vocabularies and embeddings are grown with the new users and games, the model is fitted on the
+    interactions that weren't in the previous training and the retrieval index is rebuilt for all the interactions.
+
+    Parameters:
+        df (pandas.DataFrame): All the current interactions, with the 'user_id' and 'to_recommend' columns.
+        batch_size (int, optional): The number of interactions per training batch. Defaults to 8192.
+        epochs (int, optional): The number of training epochs. Defaults to 2.
+
+    Returns:
+        tuple: The fine-tuned 'GamesModel' and the retrieval index.
+    """
+    state = np.load(f'{state_path}/state.npz')
+    trained = pd.read_parquet(f'{state_path}/interactions.parquet')
+
+    df = df[['user_id', 'to_recommend']]
+    new = df.merge(trained, how='left', indicator=True)
+    new = new.loc[new['_merge'] == 'left_only', ['user_id', 'to_recommend']]
+
+    unique_games_ids, game_embeddings = grow_vocabulary(state['games'], state['game_embeddings'], df['to_recommend'].to_numpy(dtype=str))
+    unique_users_ids, user_embeddings = grow_vocabulary(state['users'], state['user_embeddings'], df['user_id'].to_numpy(dtype=str))
+    print(f'{len(new)} new interactions, {len(unique_users_ids) - len(state["users"])} new users and {len(unique_games_ids) - len(state["games"])} new games')
+
+    games = tf.data.Dataset.from_tensor_slices(unique_games_ids)
 
-    print('Model Saved')
+    model = GamesModel(unique_games_ids, unique_users_ids, games, game_embeddings=game_embeddings, user_embeddings=user_embeddings)
+    if not new.empty:
+        fit_model(model, interactions_dataset(new), len(new), batch_size, epochs)
+    save_state(model, df)
+
+    return model, build_index(model, interactions_dataset(df), batch_size)
+
+@calc_ejecution_time
+def materialize_recommendations(model, index, n=5, batch_size=4096, save=True):
+    """
+    Score every user of the vocabulary in batches and build a table with their top-N recommended titles,
+    so the API can serve known users without running the model.
+
+    The table is saved in long format, one row per user and position, with the user ids and titles as
+    categorical columns, so every title is stored once however many users it is recommended to.
+
+    Parameters:
+        model (GamesModel): The trained model.
+        index (tfrs.layers.factorized_top_k.BruteForce): The retrieval index.
+        n (int, optional): The number of recommendations per user. Defaults to 5.
+        batch_size (int, optional): The number of users scored at once. Defaults to 4096.
+        save (bool, optional): Whether to save the table to 'recommendations_path'. Defaults to True.
+
+    Returns:
+        pandas.DataFrame: A DataFrame with the 'user_id' and 'recommendations' (list of titles) columns.
+    """
+    users = np.asarray(model.unique_users_ids, dtype=str)
+    recommendations = []
+
+    for start in range(0, len(users), batch_size):
+        _, titles = index(tf.constant(users[start:start + batch_size]), k=n)
+        titles = np.char.decode(titles.numpy().astype(bytes), 'utf-8')
+        titles = np.char.partition(titles, ',')[..., 0] # Keep only the title, as the API does
+        recommendations.extend(titles.tolist())
+
+    df = pd.DataFrame({'user_id': users, 'recommendations': recommendations})
+    record_rows(rows_in=len(users), rows_out=len(df))
+
+    if save:
+        long_df = pd.DataFrame({
+            'user_id': np.repeat(users, n),
+            'position': np.tile(np.arange(1, n + 1), len(users)),
+            'title': [title for titles in recommendations for title in titles]
+            })
+        save_serving_dataset(long_df, recommendations_path, categories=['user_id', 'title'], integers=['position'], index=False)
+        print('Recommendations Saved')
+
+    return df
 
 def list_to_str(list):
     return ', '.join(list)
 
-def main():
-    df_s = pd.read_parquet('CleanDatasets/collaborative_filtering.parquet')
+def load_interactions(filename='CleanDatasets/collaborative_filtering.parquet'):
+    """
+    Load the positive interactions used to train the model.
+
+    Parameters:
+        filename (str, optional): The collaborative filtering dataset. Defaults to 'CleanDatasets/collaborative_filtering.parquet'.
+
+    Returns:
+        pandas.DataFrame: The positive interactions, with the 'user_id', 'title' and 'to_recommend' columns.
+    """
+    df_s = pd.read_parquet(filename)
     # Select only positive reviews
     df_s = df_s[df_s['sentiment_analysis'] == 2]
     df_s['labels_2'] = df_s['labels'].apply(list_to_str)
     # Merge the games titles and labels to get more accurate recommendations
     df_s['to_recommend'] = df_s['title'] + ', ' + df_s['labels_2']
-    data = {name:value.tolist() for name, value in df_s[['user_id','to_recommend']].items()}
-    train_model(data)
+
+    return df_s[['user_id', 'title', 'to_recommend']]
+
+@calc_ejecution_time
+def main(batch_size=8192, epochs=2, incremental=False):
+    df_s = load_interactions()
+    record_rows(rows_in=len(df_s))
+    # Warm-start from the previous training when there is one
+    if incremental and os.path.exists(f'{state_path}/state.npz'):
+        model, index = train_incremental(df_s[['user_id', 'to_recommend']], batch_size=batch_size, epochs=epochs)
+    else:
+        model, index = train_model(df_s[['user_id', 'to_recommend']], batch_size=batch_size, epochs=epochs)
+    materialize_recommendations(model, index)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(incremental='--incremental' in sys.argv)
\ No newline at end of file